@@ -1,9 +1,11 @@
 import datetime
 import json
 import os
+import random
 import socket
 import time
-from threading import Thread
+from collections import defaultdict
+from threading import Event, Lock, Thread
 
 import kombu
 import requests
@@ -28,7 +30,9 @@ RABBITMQ_MQTT_PORT = os.getenv('RABBITMQ_MQTT_PORT')
 RABBITMQ_MEDIA_PLAYER_USER = os.getenv('RABBITMQ_MEDIA_PLAYER_USER')
 RABBITMQ_MEDIA_PLAYER_PASS = os.getenv('RABBITMQ_MEDIA_PLAYER_PASS')
 AMQP_PORT = os.getenv('AMQP_PORT')
-RABBITMQ_RETRY_SECONDS = int(os.getenv('RABBITMQ_RETRY_SECONDS', '2'))
+RABBITMQ_RETRY_SECONDS = float(os.getenv('RABBITMQ_RETRY_SECONDS', '2'))
+RABBITMQ_MAX_RETRY_SECONDS = float(os.getenv('RABBITMQ_MAX_RETRY_SECONDS', '30'))
+RABBITMQ_FAILOVER_TIMEOUTS = int(os.getenv('RABBITMQ_FAILOVER_TIMEOUTS', '5'))
 SENTRY_ID = os.getenv('SENTRY_ID')
 
 BALENA_APP_ID = os.getenv('BALENA_APP_ID')
@@ -40,6 +44,8 @@ CACHE_DIR = os.getenv('CACHE_DIR', '/data/')
 
 LABEL_TEMPLATE = os.getenv('LABEL_TEMPLATE', 'playlist.html')
 COLLECT_POSITION = os.getenv('COLLECT_POSITION', None)
+RECORD_TRAFFIC_FILE = os.getenv('RECORD_TRAFFIC_FILE', None)
+EVENT_STREAM_KEEPALIVE_SECONDS = float(os.getenv('EVENT_STREAM_KEEPALIVE_SECONDS', '15'))
 
 # Setup Sentry
 sentry_sdk.init(
@@ -48,6 +54,8 @@ sentry_sdk.init(
 )
 AMQP_URL = f'amqp://{RABBITMQ_MEDIA_PLAYER_USER}:{RABBITMQ_MEDIA_PLAYER_PASS}'\
            f'@{RABBITMQ_MQTT_HOST}:{AMQP_PORT}//'
+# Comma separated broker URLs to fail over between, defaulting to the single AMQP_URL
+AMQP_URLS = [url.strip() for url in (os.getenv('AMQP_URLS') or AMQP_URL).split(',') if url.strip()]
 QUEUE_NAME = f'mqtt-subscription-playback_{XOS_MEDIA_PLAYER_ID}'
 ROUTING_KEY = f'mediaplayer.{XOS_MEDIA_PLAYER_ID}'
 
@@ -58,6 +66,29 @@ app = Flask(__name__)  # pylint: disable=C0103
 CACHED_PLAYLIST_JSON = f'playlist_{XOS_PLAYLIST_ID}.json'
 # instantiate the peewee database
 db = SqliteDatabase('message.db')  # pylint: disable=C0103
+RECORD_TRAFFIC_LOCK = Lock()
+
+
+def record_traffic(event_type, body):
+    """
+    Append a playback message or tap to RECORD_TRAFFIC_FILE so it can be
+    replayed later by `app.soak`. Does nothing if RECORD_TRAFFIC_FILE isn't set.
+
+    :param event_type: Either 'playback' or 'tap'
+    :type event_type: str
+    :param body: The AMQP message body or the tap request JSON
+    :type body: dict
+    """
+    if not RECORD_TRAFFIC_FILE:
+        return
+    line = json.dumps({'time': time.time(), 'type': event_type, 'body': body}, default=str)
+    try:
+        with RECORD_TRAFFIC_LOCK:
+            with open(RECORD_TRAFFIC_FILE, 'a', encoding='utf-8') as record_file:
+                record_file.write(f'{line}\n')
+    except OSError as exception:
+        # recording is diagnostic only, so it mustn't break taps or consuming messages
+        print(f'Couldn\'t record traffic to {RECORD_TRAFFIC_FILE}: {exception}')
 
 
 class Message(Model):  # pylint: disable=R0903
@@ -73,7 +104,7 @@ class Message(Model):  # pylint: disable=R0903
         database = db
 
 
-class PlaylistLabel():
+class PlaylistLabel():  # pylint: disable=R0902
     """
     A playlist label that communicates with XOS to download labels,
     and sends lens taps back to XOS with the label tapped.
@@ -82,6 +113,17 @@ class PlaylistLabel():
     def __init__(self):
         self.playlist = None
         self.errors_history = {}
+        self.stop_event = Event()
+        self.consumer = None
+        self.broker_url = None
+        self.broker_health = defaultdict(
+            lambda: {'consecutive_failures': 0, 'connect_seconds': None}
+        )
+        self.connection_lost_at = None
+        self.last_reconnect_seconds = None
+        self.retry_attempt = 0
+        self.connection_proven = False
+        self.quiet_brokers = set()
 
     @staticmethod
     def process_media(body, message):
@@ -90,6 +132,7 @@ class PlaylistLabel():
         """
         try:
             message.ack()
+            record_traffic('playback', body)
 
             Message.create(
                 datetime=body['datetime'],
@@ -116,42 +159,195 @@ class PlaylistLabel():
 
     def consume(self, conn):
         """
-        Try to consume from RabbitMQ queue and store the received message.
+        Consume from RabbitMQ queue and store the received messages until the connection
+        is lost, or until the media player goes quiet and there are other brokers to try.
+
+        The consumer and its queue declarations are kept and revived on each new connection,
+        and anything the broker retained while we were away is resynced straight away.
+
+        The connection counts as proven once it delivers a message or stays up for
+        RABBITMQ_MAX_RETRY_SECONDS, which also resets the backoff.
+
+        :return: Whether we stopped because of a connection error
+        :rtype: bool
         """
         connection_errors = conn.connection_errors + (kombu.exceptions.OperationalError,)
+        self.connection_proven = False
         try:
-            conn.ensure_connection(max_retries=3)
-            with conn.Consumer(PLAYBACK_QUEUE, callbacks=[self.process_media]):
-                # Process messages and handle events on all channels
-                while True:
-                    try:
-                        conn.drain_events(timeout=2)
-                        resolved_timeout = self.clear_error_history('media_player_timeout')
-                        if resolved_timeout:
-                            print(f'Automatically resolved: {resolved_timeout}. '
-                                  'Now receiving messages.')
-                        resolved_conn = self.clear_error_history('rabbitmq_conn_error')
-                        if resolved_conn:
-                            print(f'Automatically resolved: {resolved_conn}. '
-                                  'Connection reestablished.')
-                    except socket.timeout as exception:
-                        print(f'Stopped receiving messages from media player {XOS_MEDIA_PLAYER_ID}')
-                        self.send_error('media_player_timeout', exception, every=3600)
-                        conn.heartbeat_check()
+            if self.consumer is None:
+                self.consumer = conn.Consumer(PLAYBACK_QUEUE, callbacks=[self.process_media])
+            else:
+                self.consumer.revive(conn.default_channel)
+            self.resync(conn)
+            self.consumer.consume()
+            connected_at = time.monotonic()
+            if self.connection_lost_at is not None:
+                self.last_reconnect_seconds = connected_at - self.connection_lost_at
+                self.connection_lost_at = None
+                print(f'Reconnected to RabbitMQ in {self.last_reconnect_seconds:.2f} seconds')
+
+            # Process messages and handle events on all channels
+            timeouts = 0
+            while not self.stop_event.is_set():
+                try:
+                    conn.drain_events(timeout=2)
+                    timeouts = 0
+                    self.connection_proven = True
+                    self.retry_attempt = 0
+                    self.quiet_brokers.clear()
+                    self.broker_health[self.broker_url]['consecutive_failures'] = 0
+                    resolved_timeout = self.clear_error_history('media_player_timeout')
+                    if resolved_timeout:
+                        print(f'Automatically resolved: {resolved_timeout}. '
+                              'Now receiving messages.')
+                    resolved_conn = self.clear_error_history('rabbitmq_conn_error')
+                    if resolved_conn:
+                        print(f'Automatically resolved: {resolved_conn}. '
+                              'Connection reestablished.')
+                except socket.timeout as exception:
+                    print(f'Stopped receiving messages from media player {XOS_MEDIA_PLAYER_ID}')
+                    self.send_error('media_player_timeout', exception, every=3600)
+                    conn.heartbeat_check()
+                    if time.monotonic() - connected_at >= RABBITMQ_MAX_RETRY_SECONDS:
+                        # the connection has stayed up, so back off afresh if it drops
+                        self.connection_proven = True
+                        self.retry_attempt = 0
+                    timeouts += 1
+                    if self.quiet_failover_due(timeouts):
+                        # the media player may have failed over to another broker
+                        print(f'Trying another RabbitMQ server after {timeouts} timeouts')
+                        self.quiet_brokers.add(self.broker_url)
+                        return False
         except connection_errors as conn_error:
-            # error with the connection, wait and try to connect again
             print(f'Error connecting to RabbitMQ server: {conn_error}')
             self.send_error('rabbitmq_conn_error', conn_error, on_rep=3, every=3600)
-            print(f'Retrying in {RABBITMQ_RETRY_SECONDS} seconds')
-            time.sleep(RABBITMQ_RETRY_SECONDS)
+            self.broker_failed(self.broker_url)
+            return True
+        return False
 
-    def get_events(self):
+    def quiet_failover_due(self, timeouts):
+        """
+        Whether to try another broker because the media player has gone quiet.
+        Only while there's a broker we haven't already found quiet since the last message,
+        so a paused or switched off media player stops the label after one round of brokers.
+
+        :param timeouts: The number of consecutive media player timeouts
+        :type timeouts: int
+        :rtype: bool
+        """
+        if timeouts < RABBITMQ_FAILOVER_TIMEOUTS:
+            return False
+        return bool(set(AMQP_URLS) - self.quiet_brokers - {self.broker_url})
+
+    def resync(self, conn):
         """
-        Create a connection to RabbitMQ server and try to consume.
+        Fetch the playback messages retained in our queue while we were disconnected,
+        and store only the latest so the label catches up without replaying the backlog.
         """
+        queue = PLAYBACK_QUEUE(conn.default_channel)
+        latest = None
         while True:
-            with Connection(AMQP_URL, heartbeat=5, connect_timeout=5) as conn:
-                self.consume(conn)
+            message = queue.get()
+            if message is None:
+                break
+            if latest is not None:
+                latest.ack()
+            latest = message
+        if latest is not None:
+            self.process_media(latest.decode(), latest)
+
+    def broker_failed(self, url):
+        """
+        Count a failure against a broker, and start timing how long it takes to reconnect.
+
+        :param url: The broker URL from AMQP_URLS
+        :type url: str
+        """
+        self.broker_health[url]['consecutive_failures'] += 1
+        if self.connection_lost_at is None:
+            self.connection_lost_at = time.monotonic()
+
+    def ranked_brokers(self):
+        """
+        Return AMQP_URLS ordered healthiest first: fewest consecutive failures,
+        then any broker we left because the media player went quiet,
+        then quickest to connect, then the configured order.
+
+        :return: Broker URLs to try in order
+        :rtype: list
+        """
+        return sorted(AMQP_URLS, key=lambda url: (
+            self.broker_health[url]['consecutive_failures'],
+            url in self.quiet_brokers,
+            self.broker_health[url]['connect_seconds'] or 0,
+        ))
+
+    @staticmethod
+    def retry_seconds(attempt):
+        """
+        Exponential backoff with jitter, so labels don't all reconnect to a restarted
+        broker at once. Starts at RABBITMQ_RETRY_SECONDS and is capped at
+        RABBITMQ_MAX_RETRY_SECONDS.
+
+        :param attempt: The number of backoffs since we last received a message, from 0
+        :type attempt: int
+        :return: Seconds to wait before trying the brokers again
+        :rtype: float
+        """
+        delay = min(RABBITMQ_MAX_RETRY_SECONDS, RABBITMQ_RETRY_SECONDS * 2 ** attempt)
+        return random.uniform(delay / 2, delay)
+
+    def backoff(self):
+        """
+        Wait before reconnecting, for longer each time until we receive a message again.
+        """
+        retry_seconds = self.retry_seconds(self.retry_attempt)
+        print(f'Retrying in {retry_seconds:.1f} seconds')
+        self.stop_event.wait(retry_seconds)
+        self.retry_attempt += 1
+
+    def connect(self):
+        """
+        Connect to the healthiest RabbitMQ server, failing over straight away to the next
+        one in AMQP_URLS, and backing off only once every server has failed.
+
+        :return: The connection, or None if we were stopped before connecting
+        :rtype: :class:`kombu.Connection`
+        """
+        while not self.stop_event.is_set():
+            for url in self.ranked_brokers():
+                conn = Connection(url, heartbeat=5, connect_timeout=5)
+                started = time.monotonic()
+                try:
+                    conn.ensure_connection(max_retries=0)
+                except conn.connection_errors + (kombu.exceptions.OperationalError,) as conn_error:
+                    conn.release()
+                    print(f'Error connecting to RabbitMQ server {conn.as_uri()}: {conn_error}')
+                    self.send_error('rabbitmq_conn_error', conn_error, on_rep=3, every=3600)
+                    self.broker_failed(url)
+                    continue
+                self.broker_health[url]['connect_seconds'] = time.monotonic() - started
+                self.broker_url = url
+                return conn
+            self.backoff()
+        return None
+
+    def get_events(self):
+        """
+        Connect to a RabbitMQ server and consume, reconnecting whenever the connection is lost.
+        After a proven connection drops we fail over to the other brokers straight away.
+        We back off first if there's no other broker, or if the connection dropped before
+        proving itself, so a broker that accepts connections and drops them isn't hammered.
+        """
+        while not self.stop_event.is_set():
+            conn = self.connect()
+            if conn is None:
+                return
+            with conn:
+                connection_lost = self.consume(conn)
+            if connection_lost and not self.stop_event.is_set() and \
+                    (len(AMQP_URLS) < 2 or not self.connection_proven):
+                self.backoff()
 
     def send_error(self, error_name, error, on_rep=5, every=100, units='seconds'):
         # pylint: disable=too-many-arguments
@@ -308,6 +504,7 @@ def collect_item():
         tap_to_process.save()
 
     xos_tap = dict(request.get_json())
+    record_traffic('tap', xos_tap)
     record = model_to_dict(Message.select().order_by(Message.datetime.desc()).get())
     xos_tap['label'] = record.pop('label_id', None)
     xos_tap.setdefault('data', {})['playlist_info'] = record
@@ -330,8 +527,13 @@ def collect_item():
 
 
 def event_stream():
+    last_sent = time.monotonic()
     while True:
         time.sleep(0.1)
+        if time.monotonic() - last_sent >= EVENT_STREAM_KEEPALIVE_SECONDS:
+            # an SSE comment the browser ignores, so streams whose client has gone get closed
+            last_sent = time.monotonic()
+            yield ': keep-alive\n\n'
         try:
             has_tapped = HasTapped.get_or_none(tap_processing=1, has_tapped=1)
             if has_tapped:
@@ -340,6 +542,7 @@ def event_stream():
                 has_tapped.tap_processing = 0
                 has_tapped.tap_successful = 0
                 has_tapped.save()
+                last_sent = time.monotonic()
                 yield tap_event_message
         except OperationalError as exception:
             template = 'An exception of type {0} {1!r} occurred in event_stream '\
@@ -0,0 +1,469 @@
+"""
+Record-and-replay soak harness for the playlist label.
+
+Record real traffic by running the label with RECORD_TRAFFIC_FILE set, then replay it
+against `app.main` at N times speed using a local `memory://` broker and a stub XOS:
+
+    python -m app.soak traffic.jsonl --speed 600 --duration 604800
+
+The harness samples RSS, open file descriptors, thread count, tracemalloc top allocators
+and tap latency while it replays, and exits non-zero if anything grows past its threshold.
+"""
+import argparse
+import datetime
+import json
+import logging
+import math
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Thread, active_count
+from threading import enumerate as enumerate_threads
+
+import requests
+from kombu import Connection
+from peewee import SqliteDatabase
+from werkzeug.serving import make_server
+
+from app import main
+from app.main import HasTapped, Message, PlaylistLabel
+
+SOAK_TRANSPORT_URL = 'memory://'
+# kombu's memory transport polls once a second by default, far slower than a real broker delivers
+SOAK_TRANSPORT_OPTIONS = {'polling_interval': 0.01}
+SOAK_KEEPALIVE_SECONDS = 0.5
+
+
+def load_recording(path):
+    """
+    Read a traffic recording made with RECORD_TRAFFIC_FILE.
+
+    :param path: The path to the JSON lines recording
+    :type path: str
+    :return: The recorded events with an `offset` in seconds from the first event
+    :rtype: list
+    """
+    with open(path, encoding='utf-8') as recording:
+        events = [json.loads(line) for line in recording if line.strip()]
+    if not events:
+        raise ValueError(f'No traffic recorded in {path}')
+    events.sort(key=lambda event: event['time'])
+    start = events[0]['time']
+    for event in events:
+        event['offset'] = event['time'] - start
+    return events
+
+
+def percentile(values, percent):
+    """
+    Return the nearest-rank percentile of a list of values, or None if it's empty.
+    """
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(0, math.ceil(percent / 100 * len(ordered)) - 1)
+    return ordered[rank]
+
+
+def rss_megabytes():
+    """
+    Return the resident set size of this process in megabytes, or None where /proc
+    isn't available. Peak RSS from getrusage can't show growth, so isn't used instead.
+    """
+    try:
+        with open('/proc/self/status', encoding='utf-8') as status:
+            for line in status:
+                if line.startswith('VmRSS:'):
+                    return round(int(line.split()[1]) / 1024, 1)
+    except FileNotFoundError:
+        pass
+    return None
+
+
+def open_file_descriptors():
+    """
+    Return the number of open file descriptors, or None if it can't be counted.
+    """
+    for fd_dir in ('/proc/self/fd', '/dev/fd'):
+        try:
+            return len(os.listdir(fd_dir))
+        except FileNotFoundError:
+            continue
+    return None
+
+
+class StubXOSHandler(BaseHTTPRequestHandler):
+    """
+    Accepts taps like XOS does and echoes them back with a 201.
+    """
+
+    def do_POST(self):  # pylint: disable=C0103
+        length = int(self.headers.get('Content-Length', 0))
+        body = self.rfile.read(length) or b'{}'
+        self.send_response(201)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):  # pylint: disable=W0622
+        pass
+
+
+class SoakHarness():
+    """
+    Replays recorded playback messages and taps against `app.main`
+    and checks that memory, file descriptors, threads and latency stay flat.
+    """
+
+    # pylint: disable=too-many-instance-attributes
+
+    def __init__(self, events, speed=60, duration=None, sample_every=3600, thresholds=None):
+        # pylint: disable=too-many-arguments
+        self.events = events
+        self.speed = speed
+        self.duration = duration or events[-1]['offset']
+        self.sample_every = sample_every
+        self.thresholds = {
+            'rss_growth_mb': 20,
+            'fd_growth': 10,
+            'thread_growth': 5,
+            'p99_ms': 500,
+            # process_media trims to 5 rows just after each insert, so allow some in flight
+            'message_rows': 10,
+            'errors_history': 10,
+        }
+        self.thresholds.update(thresholds or {})
+        self.samples = []
+        self.latencies = []
+        self.tap_events = 0
+        self.playbacks_published = 0
+        self.playbacks_processed = 0
+        self.playlist_label = PlaylistLabel()
+        self.playlist_label.process_media = self.process_media
+        self.threads = []
+        self.threads_before = set()
+        self.consumer_thread = None
+        self.consumer_connection = None
+        self.tmp_dir = None
+        self.database = None
+        self.flask_server = None
+        self.xos_server = None
+        self.label_url = None
+        self.original_settings = {}
+
+    def start(self):
+        """
+        Bind the models to a scratch database, and start the label's consumer,
+        its Flask server and a stub XOS.
+        """
+        self.threads_before = set(enumerate_threads())
+        self.tmp_dir = tempfile.TemporaryDirectory()  # pylint: disable=R1732
+        self.database = SqliteDatabase(os.path.join(self.tmp_dir.name, 'soak.db'))
+        self.database.bind([Message, HasTapped], bind_refs=False, bind_backrefs=False)
+        self.database.create_tables([Message, HasTapped])
+        HasTapped.create(has_tapped=0, tap_successful=0, tap_processing=0)
+
+        self.xos_server = ThreadingHTTPServer(('127.0.0.1', 0), StubXOSHandler)
+        logging.getLogger('werkzeug').setLevel(logging.WARNING)
+        self.flask_server = make_server('127.0.0.1', 0, main.app, threaded=True)
+        self.label_url = f'http://127.0.0.1:{self.flask_server.port}'
+
+        self.original_settings = {
+            'XOS_TAPS_ENDPOINT': main.XOS_TAPS_ENDPOINT,
+            'AUTH_TOKEN': main.AUTH_TOKEN,
+            'RECORD_TRAFFIC_FILE': main.RECORD_TRAFFIC_FILE,
+            'EVENT_STREAM_KEEPALIVE_SECONDS': main.EVENT_STREAM_KEEPALIVE_SECONDS,
+        }
+        main.XOS_TAPS_ENDPOINT = f'http://127.0.0.1:{self.xos_server.server_port}/api/taps/'
+        main.AUTH_TOKEN = main.AUTH_TOKEN or 'soak'
+        main.RECORD_TRAFFIC_FILE = None
+        # keep-alives let the tap-source stream notice quickly when the listener has gone
+        main.EVENT_STREAM_KEEPALIVE_SECONDS = SOAK_KEEPALIVE_SECONDS
+
+        self.consumer_connection = Connection(
+            SOAK_TRANSPORT_URL, transport_options=SOAK_TRANSPORT_OPTIONS,
+        )
+        # kombu never declares amq.* exchanges, so create it on the in-memory broker
+        self.consumer_connection.default_channel.exchange_declare(
+            exchange=main.MEDIA_PLAYER_EXCHANGE.name,
+            type=main.MEDIA_PLAYER_EXCHANGE.type,
+            durable=True,
+        )
+        self.consumer_thread = Thread(
+            target=self.playlist_label.consume, args=(self.consumer_connection,), daemon=True,
+        )
+        self.threads = [
+            Thread(target=self.xos_server.serve_forever, daemon=True),
+            Thread(target=self.flask_server.serve_forever, daemon=True),
+            self.consumer_thread,
+            Thread(target=self.listen_for_tap_events, daemon=True),
+        ]
+        for thread in self.threads:
+            thread.start()
+
+    def stop(self):
+        """
+        Stop everything started by `start` and restore the label's settings.
+        """
+        self.playlist_label.stop_event.set()
+        # let the consumer finish its last drain so it can't take messages meant for anyone else
+        self.consumer_thread.join()
+        self.consumer_connection.release()
+        self.flask_server.shutdown()
+        self.flask_server.server_close()
+        self.xos_server.shutdown()
+        self.xos_server.server_close()
+        # wait for the listener, and the request threads serving it, before pulling the database
+        for thread in self.running_threads():
+            thread.join(timeout=5)
+            if thread.is_alive():
+                print(f'Soak thread {thread.name} is still running after stopping')
+        for setting, value in self.original_settings.items():
+            setattr(main, setting, value)
+        self.database.close()
+        main.db.bind([Message, HasTapped], bind_refs=False, bind_backrefs=False)
+        self.tmp_dir.cleanup()
+
+    def running_threads(self):
+        """
+        Return the harness's own threads, and the server request threads it started,
+        that are still running.
+        """
+        return [
+            thread for thread in enumerate_threads()
+            if thread not in self.threads_before
+            and (thread in self.threads or 'process_request_thread' in thread.name)
+        ]
+
+    def listen_for_tap_events(self):
+        """
+        Hold a `/api/tap-source/` stream open like the label's browser does,
+        reconnecting if it drops, until the harness is stopped.
+        """
+        read_timeout = SOAK_KEEPALIVE_SECONDS * 4
+        while not self.playlist_label.stop_event.is_set():
+            try:
+                with requests.get(
+                        f'{self.label_url}/api/tap-source/', stream=True, timeout=(5, read_timeout),
+                ) as response:
+                    for line in response.iter_lines():
+                        if self.playlist_label.stop_event.is_set():
+                            break
+                        if line.startswith(b'data:'):
+                            self.tap_events += 1
+            except requests.exceptions.RequestException:
+                self.playlist_label.stop_event.wait(1)
+
+    def process_media(self, body, message):
+        """
+        Store a playback message with the label's own process_media, counting it.
+        """
+        PlaylistLabel.process_media(body, message)
+        self.playbacks_processed += 1
+
+    def wait_for_consumer(self, timeout=10):
+        """
+        Wait for the label to process every playback message published so far.
+
+        :return: Whether the consumer caught up before the timeout
+        :rtype: bool
+        """
+        deadline = time.monotonic() + timeout
+        while self.playbacks_processed < self.playbacks_published:
+            if time.monotonic() > deadline:
+                return False
+            time.sleep(0.01)
+        return True
+
+    def publish(self, producer, body, simulated_time):
+        """
+        Publish a playback message as the media player would, stamped with the simulated time.
+        """
+        body = dict(body, datetime=simulated_time.isoformat())
+        producer.publish(
+            body,
+            exchange=main.MEDIA_PLAYER_EXCHANGE,
+            routing_key=main.ROUTING_KEY,
+            declare=[main.PLAYBACK_QUEUE],
+        )
+        self.playbacks_published += 1
+
+    def tap(self, session, body):
+        """
+        Post a tap to the label and record how long it took.
+        """
+        start = time.perf_counter()
+        try:
+            session.post(f'{self.label_url}/api/taps/', json=body, timeout=10)
+        except requests.exceptions.RequestException as exception:
+            print(f'Tap failed during soak: {exception}')
+        self.latencies.append((time.perf_counter() - start) * 1000)
+
+    def sample(self, simulated_seconds, baseline_snapshot):
+        """
+        Record resource usage, and the allocators that have grown most since the baseline,
+        once the consumer has caught up with the playback messages published so far.
+        """
+        caught_up = self.wait_for_consumer()
+        snapshot = tracemalloc.take_snapshot()
+        top_allocators = [
+            str(stat) for stat in snapshot.compare_to(baseline_snapshot, 'lineno')[:5]
+        ]
+        self.samples.append({
+            'simulated_seconds': simulated_seconds,
+            'rss_mb': rss_megabytes(),
+            'open_fds': open_file_descriptors(),
+            'threads': active_count(),
+            'p99_ms': percentile(self.latencies, 99),
+            'message_rows': Message.select().count(),
+            'errors_history': len(self.playlist_label.errors_history),
+            'tap_events': self.tap_events,
+            'playbacks_published': self.playbacks_published,
+            'playbacks_processed': self.playbacks_processed,
+            'caught_up': caught_up,
+            'top_allocators': top_allocators,
+        })
+        self.latencies = []
+        print(
+            f'[{datetime.timedelta(seconds=int(simulated_seconds))}] '
+            f'rss={self.samples[-1]["rss_mb"]}MB fds={self.samples[-1]["open_fds"]} '
+            f'threads={self.samples[-1]["threads"]} p99={self.samples[-1]["p99_ms"]}ms '
+            f'messages={self.samples[-1]["message_rows"]} '
+            f'tap_events={self.samples[-1]["tap_events"]} '
+            f'playbacks={self.samples[-1]["playbacks_processed"]}/'
+            f'{self.samples[-1]["playbacks_published"]}'
+        )
+
+    def replay(self):
+        """
+        Replay the recording, looping it until `duration` simulated seconds have passed.
+
+        :return: The failures found by `check`
+        :rtype: list
+        """
+        tracemalloc.start()
+        baseline_snapshot = tracemalloc.take_snapshot()
+        start_time = datetime.datetime.now()
+        loop_length = self.events[-1]['offset'] + 1
+        simulated_seconds = 0
+        next_sample = self.sample_every
+        loop = 0
+        try:
+            with Connection(SOAK_TRANSPORT_URL) as connection, requests.Session() as session:
+                producer = connection.Producer()
+                # collecting a tap needs at least one playback message
+                seed_time = start_time - datetime.timedelta(seconds=1)
+                self.publish(producer, self.events[0].get('body', {}), seed_time)
+                self.wait_for_consumer()
+                while simulated_seconds < self.duration:
+                    for event in self.events:
+                        event_seconds = loop * loop_length + event['offset']
+                        if event_seconds > self.duration:
+                            break
+                        time.sleep(max(0, event_seconds - simulated_seconds) / self.speed)
+                        simulated_seconds = event_seconds
+                        if event['type'] == 'playback':
+                            simulated_time = start_time + datetime.timedelta(seconds=event_seconds)
+                            self.publish(producer, event['body'], simulated_time)
+                        elif event['type'] == 'tap':
+                            self.tap(session, event['body'])
+                        if simulated_seconds >= next_sample:
+                            self.sample(simulated_seconds, baseline_snapshot)
+                            next_sample += self.sample_every
+                    loop += 1
+                    simulated_seconds = max(simulated_seconds, loop * loop_length)
+                if not self.samples or self.samples[-1]['simulated_seconds'] < simulated_seconds:
+                    self.sample(simulated_seconds, baseline_snapshot)
+        finally:
+            tracemalloc.stop()
+        return self.check()
+
+    def check(self):
+        """
+        Compare the last sample against the first and return a list of threshold failures.
+        """
+        failures = []
+        if not self.samples:
+            return failures
+        first, last = self.samples[0], self.samples[-1]
+        growth = {
+            'thread_growth': last['threads'] - first['threads'],
+        }
+        if first['rss_mb'] is not None and last['rss_mb'] is not None:
+            growth['rss_growth_mb'] = last['rss_mb'] - first['rss_mb']
+        if first['open_fds'] is not None and last['open_fds'] is not None:
+            growth['fd_growth'] = last['open_fds'] - first['open_fds']
+        for name, value in growth.items():
+            if value > self.thresholds[name]:
+                failures.append(f'{name} {value:.1f} exceeds {self.thresholds[name]}')
+        for sample in self.samples:
+            if not sample['caught_up']:
+                failures.append(
+                    f'consumer processed {sample["playbacks_processed"]} of '
+                    f'{sample["playbacks_published"]} playback messages '
+                    f'at {sample["simulated_seconds"]:.0f} simulated seconds'
+                )
+            for name in ('p99_ms', 'message_rows', 'errors_history'):
+                if sample[name] is not None and sample[name] > self.thresholds[name]:
+                    failures.append(
+                        f'{name} {sample[name]:.1f} exceeds {self.thresholds[name]} '
+                        f'at {sample["simulated_seconds"]:.0f} simulated seconds'
+                    )
+        if failures:
+            print('Allocators that grew the most:')
+            for allocator in last['top_allocators']:
+                print(f'  {allocator}')
+        return failures
+
+
+def soak(path, **kwargs):
+    """
+    Replay a recording against the label and return any threshold failures.
+    """
+    harness = SoakHarness(load_recording(path), **kwargs)
+    harness.start()
+    try:
+        return harness.replay()
+    finally:
+        harness.stop()
+
+
+def parse_args(args=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('recording', help='JSON lines file recorded with RECORD_TRAFFIC_FILE')
+    parser.add_argument('--speed', type=float, default=60, help='Replay speed multiplier')
+    parser.add_argument(
+        '--duration', type=float, default=None,
+        help='Simulated seconds to replay for, looping the recording (default: one pass)',
+    )
+    parser.add_argument(
+        '--sample-every', type=float, default=3600, help='Simulated seconds between samples',
+    )
+    parser.add_argument('--max-rss-growth-mb', type=float, default=20)
+    parser.add_argument('--max-fd-growth', type=int, default=10)
+    parser.add_argument('--max-thread-growth', type=int, default=5)
+    parser.add_argument('--max-p99-ms', type=float, default=500)
+    return parser.parse_args(args)
+
+
+if __name__ == '__main__':
+    ARGS = parse_args()
+    FAILURES = soak(
+        ARGS.recording,
+        speed=ARGS.speed,
+        duration=ARGS.duration,
+        sample_every=ARGS.sample_every,
+        thresholds={
+            'rss_growth_mb': ARGS.max_rss_growth_mb,
+            'fd_growth': ARGS.max_fd_growth,
+            'thread_growth': ARGS.max_thread_growth,
+            'p99_ms': ARGS.max_p99_ms,
+        },
+    )
+    for FAILURE in FAILURES:
+        print(f'FAIL: {FAILURE}')
+    sys.exit(1 if FAILURES else 0)
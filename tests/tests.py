@@ -1,11 +1,18 @@
 import datetime
 import json
+import socket
 import time
+from collections import Counter
+from functools import partial
+from threading import Thread
 from unittest.mock import MagicMock, patch
 
 import pytest
+from kombu import Connection
+from kombu.transport import memory, virtual
+from peewee import SqliteDatabase
 
-from app import cache, main
+from app import cache, main, soak
 from app.cache import create_cache
 from app.main import HasTapped, Message, PlaylistLabel
 
@@ -44,6 +51,155 @@ def mocked_requests_post(*args, **kwargs):
     raise Exception("No mocked sample data for request: "+args[0])
 
 
+# generous allowance on top of the backoff for slow CI, e.g. ARM builds under QEMU
+RECONNECT_SLACK_SECONDS = 2
+
+
+class StandInChannel(memory.Channel):  # pylint: disable=W0223
+    """
+    An in-memory channel whose queues belong to its stand-in broker.
+    """
+
+    @property
+    def queues(self):
+        # closing channels outlive their connection to the broker
+        if self.connection is None:
+            return {}
+        return self.connection.broker['queues']
+
+    @queues.setter
+    def queues(self, value):
+        pass
+
+
+class StandInBroker(memory.Transport):  # pylint: disable=W0223
+    """
+    In-memory stand-ins for RabbitMQ servers, keyed by hostname. Each has its own
+    exchanges, bindings and queues, which are lost when it's killed. The label can also
+    be partitioned from a broker that keeps running.
+    """
+    Channel = StandInChannel
+    connection_errors = memory.Transport.connection_errors + (ConnectionError,)
+    brokers = {}
+    stopped = set()
+    partitioned = set()
+    dropping = set()
+    connects = Counter()
+
+    @classmethod
+    def reset(cls):
+        for brokers in (cls.brokers, cls.stopped, cls.partitioned, cls.dropping, cls.connects):
+            brokers.clear()
+
+    @classmethod
+    def kill(cls, hostname):
+        cls.stopped.add(hostname)
+        cls.brokers.pop(hostname, None)
+
+    @classmethod
+    def restart(cls, hostname):
+        cls.stopped.discard(hostname)
+
+    @staticmethod
+    def start_broker():
+        state = virtual.BrokerState()
+        # RabbitMQ comes with amq.topic, and kombu never declares amq.* exchanges itself
+        state.exchanges['amq.topic'] = {
+            'type': 'direct', 'durable': True, 'auto_delete': False, 'arguments': {}, 'table': [],
+        }
+        return {'state': state, 'queues': {}}
+
+    def reachable(self):
+        hostname = self.client.hostname
+        return hostname not in self.stopped and hostname not in self.partitioned
+
+    def establish_connection(self):
+        if not self.reachable():
+            raise ConnectionRefusedError(f'{self.client.hostname} is unreachable')
+        self.connects[self.client.hostname] += 1
+        self.broker = self.brokers.setdefault(  # pylint: disable=W0201
+            self.client.hostname, self.start_broker()
+        )
+        self.state = self.broker['state']
+        return super().establish_connection()
+
+    def drain_events(self, connection, timeout=None):
+        started = time.monotonic()
+        while True:
+            if not self.reachable() or self.client.hostname in self.dropping or \
+                    self.brokers.get(self.client.hostname) is not self.broker:
+                raise ConnectionResetError(f'Lost connection to {self.client.hostname}')
+            try:
+                return super().drain_events(connection, timeout=0.05)
+            except socket.timeout:
+                if timeout is not None and time.monotonic() - started >= timeout:
+                    raise
+
+
+class MediaPlayerBroker(StandInBroker):  # pylint: disable=W0223
+    """
+    The media player's view of the stand-in brokers, unaffected by the label's partitions.
+    """
+
+    def reachable(self):
+        return self.client.hostname not in self.stopped
+
+
+def publish_playback(hostname, label_id):
+    """
+    Publish a playback message to a stand-in broker as the media player would.
+    """
+    with Connection(f'amqp://{hostname}//', transport=MediaPlayerBroker) as conn:
+        conn.Producer().publish(
+            {'datetime': str(time.time()), 'label_id': label_id, 'playback_position': 0.5},
+            exchange=main.MEDIA_PLAYER_EXCHANGE,
+            routing_key=main.ROUTING_KEY,
+        )
+
+
+def latest_label_id():
+    message = Message.select().order_by(Message.datetime.desc()).first()
+    return message.label_id if message else None
+
+
+def queue_declared(hostname):
+    broker = StandInBroker.brokers.get(hostname)
+    return broker is not None and broker['state'].has_binding(
+        main.QUEUE_NAME, main.MEDIA_PLAYER_EXCHANGE.name, main.ROUTING_KEY
+    )
+
+
+def wait_for(condition, timeout=10):
+    started = time.monotonic()
+    while not condition():
+        assert time.monotonic() - started < timeout
+        time.sleep(0.01)
+
+
+@pytest.fixture
+def stand_in_brokers(tmp_path):
+    """
+    Run PlaylistLabel.get_events against stand-in brokers a and b.
+    """
+    # the consumer runs in its own thread, so it needs a file rather than :memory: database
+    test_db = SqliteDatabase(str(tmp_path / 'message.db'))
+    test_db.bind([Message, HasTapped], bind_refs=False, bind_backrefs=False)
+    test_db.create_tables([Message, HasTapped])
+    StandInBroker.reset()
+
+    playlist_label = PlaylistLabel()
+    get_events = Thread(target=playlist_label.get_events, daemon=True)
+    with patch('app.main.Connection', partial(Connection, transport=StandInBroker)), \
+            patch('app.main.AMQP_URLS', ['amqp://broker-a//', 'amqp://broker-b//']), \
+            patch('app.main.RABBITMQ_RETRY_SECONDS', 0.1), \
+            patch('app.main.RABBITMQ_MAX_RETRY_SECONDS', 0.4):
+        yield playlist_label, get_events
+        playlist_label.stop_event.set()
+        if get_events.is_alive():
+            get_events.join()
+    main.db.bind([Message, HasTapped], bind_refs=False, bind_backrefs=False)
+
+
 @patch('requests.get', MagicMock(side_effect=mocked_requests_get))
 def test_create_cache(capsys):
     """
@@ -242,3 +398,260 @@ def test_tap_received_while_processing_still_creates(client):
     )
 
     assert response.status_code == 201
+
+
+@pytest.mark.usefixtures('database')
+def test_record_traffic(tmp_path):
+    """
+    Test that playback messages are appended to RECORD_TRAFFIC_FILE when it's set.
+    """
+    record_file = tmp_path / 'traffic.jsonl'
+    with open('tests/data/message.json', 'r') as the_file:
+        message_broker_json = json.loads(the_file.read())
+
+    with patch('app.main.RECORD_TRAFFIC_FILE', str(record_file)):
+        PlaylistLabel().process_media(message_broker_json, MagicMock())
+
+    recorded = json.loads(record_file.read_text())
+    assert recorded['type'] == 'playback'
+    assert recorded['body']['label_id'] == message_broker_json['label_id']
+
+
+@pytest.mark.usefixtures('database')
+@patch('app.main.RECORD_TRAFFIC_FILE', '/nonexistent/traffic.jsonl')
+@patch('requests.post', MagicMock(side_effect=mocked_requests_post))
+def test_record_traffic_errors_dont_break_taps(client):
+    """
+    Test that a tap still reaches XOS when the traffic recording can't be written.
+    """
+    with open('tests/data/lens_tap.json', 'r') as the_file:
+        lens_tap_data = the_file.read()
+
+    response = client.post(
+        '/api/taps/',
+        data=lens_tap_data,
+        headers={'Content-Type': 'application/json'}
+    )
+
+    assert response.status_code == 201
+
+
+def test_soak_percentile_is_nearest_rank():
+    """
+    Test that the soak harness's p99 uses the nearest rank, rounding the rank up.
+    """
+    assert soak.percentile(list(range(1, 151)), 99) == 149
+    assert soak.percentile(list(range(1, 351)), 99) == 347
+    assert soak.percentile([5], 99) == 5
+    assert soak.percentile([], 99) is None
+
+
+def test_soak_replays_recorded_traffic(tmp_path):
+    """
+    Test that the soak harness replays a recording through the label without failures.
+    """
+    with open('tests/data/message.json', 'r') as the_file:
+        message_broker_json = json.loads(the_file.read())
+    with open('tests/data/lens_tap.json', 'r') as the_file:
+        lens_tap_json = json.loads(the_file.read())
+
+    recording = tmp_path / 'traffic.jsonl'
+    with open(recording, 'w') as the_file:
+        for second in range(10):
+            playback = {'time': second, 'type': 'playback', 'body': message_broker_json}
+            the_file.write(json.dumps(playback) + '\n')
+        the_file.write(json.dumps({'time': 5, 'type': 'tap', 'body': lens_tap_json}) + '\n')
+
+    harness = soak.SoakHarness(
+        soak.load_recording(recording), speed=100, duration=30, sample_every=10
+    )
+    harness.start()
+    try:
+        failures = harness.replay()
+    finally:
+        harness.stop()
+
+    assert not failures
+    assert len(harness.samples) == 3
+    # the seed message, then 10 a loop for 3 loops
+    assert harness.playbacks_published == 31
+    assert harness.playbacks_processed == 31
+    assert harness.samples[-1]['message_rows'] == 5
+    assert not harness.running_threads()
+    assert not harness.consumer_connection.connected
+    assert Message._meta.database is main.db  # pylint: disable=E1101,W0212
+    assert harness.samples[-1]['p99_ms'] is not None or harness.samples[-2]['p99_ms'] is not None
+
+
+def test_ranked_brokers_and_retry_seconds():
+    """
+    Test that brokers are ranked by health and retries back off exponentially with jitter.
+    """
+    playlist_label = PlaylistLabel()
+    with patch('app.main.AMQP_URLS', ['amqp://a//', 'amqp://b//', 'amqp://c//']):
+        assert playlist_label.ranked_brokers() == ['amqp://a//', 'amqp://b//', 'amqp://c//']
+        playlist_label.broker_failed('amqp://a//')
+        playlist_label.broker_health['amqp://b//']['connect_seconds'] = 0.5
+        playlist_label.broker_health['amqp://c//']['connect_seconds'] = 0.1
+        assert playlist_label.ranked_brokers() == ['amqp://c//', 'amqp://b//', 'amqp://a//']
+
+    with patch('app.main.RABBITMQ_RETRY_SECONDS', 2), \
+            patch('app.main.RABBITMQ_MAX_RETRY_SECONDS', 30):
+        for attempt, delay in [(0, 2), (1, 4), (3, 16), (10, 30)]:
+            for _ in range(20):
+                assert delay / 2 <= PlaylistLabel.retry_seconds(attempt) <= delay
+
+
+def test_quiet_failover_due():
+    """
+    Test that a quiet media player only triggers a failover while there's a broker
+    we haven't already found quiet since the last message.
+    """
+    playlist_label = PlaylistLabel()
+    playlist_label.broker_url = 'amqp://a//'
+    with patch('app.main.AMQP_URLS', ['amqp://a//', 'amqp://b//']), \
+            patch('app.main.RABBITMQ_FAILOVER_TIMEOUTS', 5):
+        assert not playlist_label.quiet_failover_due(4)
+        assert playlist_label.quiet_failover_due(5)
+
+        # the broker we left goes after equally healthy ones, without counting as a failure
+        playlist_label.quiet_brokers.add('amqp://a//')
+        assert playlist_label.ranked_brokers() == ['amqp://b//', 'amqp://a//']
+
+        # b is quiet too, so that's a full round and we stay put
+        playlist_label.broker_url = 'amqp://b//'
+        assert not playlist_label.quiet_failover_due(50)
+
+    with patch('app.main.AMQP_URLS', ['amqp://a//']):
+        playlist_label.quiet_brokers.clear()
+        playlist_label.broker_url = 'amqp://a//'
+        assert not playlist_label.quiet_failover_due(50)
+
+
+def test_get_events_fails_over_to_the_next_broker(stand_in_brokers):  # pylint: disable=W0621
+    """
+    Test that get_events fails over to another broker when one is killed,
+    declaring the queue again on the restarted broker.
+    """
+    playlist_label, get_events = stand_in_brokers
+    StandInBroker.kill('broker-a')
+    get_events.start()
+    wait_for(lambda: playlist_label.broker_url == 'amqp://broker-b//')
+    assert queue_declared('broker-b')
+    consumer = playlist_label.consumer
+
+    StandInBroker.restart('broker-a')
+    StandInBroker.kill('broker-b')
+    wait_for(lambda: queue_declared('broker-a'))
+    assert playlist_label.broker_url == 'amqp://broker-a//'
+    assert playlist_label.consumer is consumer
+
+    publish_playback('broker-a', label_id=42)
+    wait_for(lambda: latest_label_id() == 42)
+    assert playlist_label.last_reconnect_seconds < \
+        main.RABBITMQ_RETRY_SECONDS + RECONNECT_SLACK_SECONDS
+
+
+def test_get_events_fails_over_straight_away_when_the_broker_dies(stand_in_brokers):  # pylint: disable=W0621
+    """
+    Test that when the broker we're consuming from dies, get_events moves to a healthy
+    broker straight away rather than backing off first.
+    """
+    playlist_label, get_events = stand_in_brokers
+    with patch('app.main.RABBITMQ_RETRY_SECONDS', 2), \
+            patch('app.main.RABBITMQ_MAX_RETRY_SECONDS', 30):
+        get_events.start()
+        wait_for(lambda: queue_declared('broker-a'))
+        publish_playback('broker-a', label_id=1)
+        wait_for(lambda: latest_label_id() == 1)
+
+        StandInBroker.kill('broker-a')
+        wait_for(lambda: playlist_label.broker_url == 'amqp://broker-b//')
+        wait_for(lambda: playlist_label.last_reconnect_seconds is not None)
+        # the first backoff would be at least half of RABBITMQ_RETRY_SECONDS
+        assert playlist_label.last_reconnect_seconds < main.RABBITMQ_RETRY_SECONDS / 4
+        assert playlist_label.retry_attempt == 0
+
+
+def test_get_events_resyncs_after_a_partition(stand_in_brokers):  # pylint: disable=W0621
+    """
+    Test that after reconnecting, get_events stores the latest playback message
+    the broker retained while the label was cut off, skipping older ones.
+    """
+    playlist_label, get_events = stand_in_brokers
+    with patch('app.main.AMQP_URLS', ['amqp://broker-a//']):
+        get_events.start()
+        wait_for(lambda: queue_declared('broker-a'))
+        publish_playback('broker-a', label_id=1)
+        wait_for(lambda: latest_label_id() == 1)
+
+        StandInBroker.partitioned.add('broker-a')
+        wait_for(lambda: playlist_label.connection_lost_at is not None)
+        publish_playback('broker-a', label_id=2)
+        publish_playback('broker-a', label_id=3)
+        healed = time.monotonic()
+        StandInBroker.partitioned.clear()
+
+        wait_for(lambda: latest_label_id() == 3)
+        assert time.monotonic() - healed < \
+            main.RABBITMQ_MAX_RETRY_SECONDS + RECONNECT_SLACK_SECONDS
+        assert not Message.select().where(Message.label_id == 2).exists()
+
+
+def test_get_events_redeclares_the_queue_when_a_broker_restarts(stand_in_brokers):  # pylint: disable=W0621
+    """
+    Test that get_events reconnects to a restarted broker that lost its queues,
+    reusing the consumer and declaring the queue again.
+    """
+    playlist_label, get_events = stand_in_brokers
+    with patch('app.main.AMQP_URLS', ['amqp://broker-a//']):
+        get_events.start()
+        wait_for(lambda: queue_declared('broker-a'))
+        consumer = playlist_label.consumer
+
+        StandInBroker.kill('broker-a')
+        wait_for(lambda: playlist_label.connection_lost_at is not None)
+        assert not queue_declared('broker-a')
+        StandInBroker.restart('broker-a')
+
+        wait_for(lambda: queue_declared('broker-a'))
+        assert playlist_label.consumer is consumer
+        publish_playback('broker-a', label_id=7)
+        wait_for(lambda: latest_label_id() == 7)
+
+
+def test_get_events_backs_off_when_a_broker_drops_connections(stand_in_brokers):  # pylint: disable=W0621
+    """
+    Test that a broker which accepts connections and drops them straight away
+    is retried with backoff, rather than in a tight loop.
+    """
+    playlist_label, get_events = stand_in_brokers
+    StandInBroker.dropping.add('broker-a')
+    with patch('app.main.AMQP_URLS', ['amqp://broker-a//']):
+        get_events.start()
+        time.sleep(1)
+        # backing off from 0.1 seconds to at most 0.4 allows only a handful of connects
+        assert StandInBroker.connects['broker-a'] <= 10
+        assert playlist_label.retry_attempt >= 2
+
+
+def test_get_events_quiet_failover_isnt_a_broker_failure(stand_in_brokers):  # pylint: disable=W0621
+    """
+    Test that a quiet media player moves the label to another broker without
+    counting against the broker's health, stops moving after a full round of brokers,
+    and starts again once a message arrives.
+    """
+    playlist_label, get_events = stand_in_brokers
+    with patch('app.main.RABBITMQ_FAILOVER_TIMEOUTS', 1):
+        get_events.start()
+        wait_for(lambda: playlist_label.broker_url == 'amqp://broker-b//')
+        assert playlist_label.broker_health['amqp://broker-a//']['consecutive_failures'] == 0
+        assert playlist_label.connection_lost_at is None
+
+        # another 2 second timeout on broker b, but both brokers have been quiet
+        time.sleep(2.5)
+        assert playlist_label.broker_url == 'amqp://broker-b//'
+
+        publish_playback('broker-b', label_id=5)
+        wait_for(lambda: latest_label_id() == 5)
+        wait_for(lambda: playlist_label.broker_url == 'amqp://broker-a//')